@@ -2,17 +2,44 @@
 
 from __future__ import annotations
 
-from multiprocessing import Process, cpu_count, current_process
+from multiprocessing import Pool, cpu_count, current_process
 from struct import Struct
 from shared_memory_handler import SharedMemoryHandlee
-from math import cos, sin, pi
+from math import pi
 from collections.abc import Iterable
 from dataclasses import dataclass
+from functools import lru_cache
 from time import sleep, time
 from shutil import get_terminal_size
+from os import environ
+import sys
+
+import numpy as np
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
 # Set to False to run it in the main process
 USE_MULTI_PROCESSING = True
+# Numba threads replace the worker processes when numba is installed
+USE_NUMBA = njit is not None
+# Experimental, not yet run on a GPU: shade with cupy instead when it is
+# installed and `SMH_USE_CUDA=1` is set
+USE_CUDA = cp is not None and environ.get("SMH_USE_CUDA") == "1"
+# Working set of the rows `worker` shades at once. Tiles of a few MiB keep
+# the temporaries in cache (L2/L3) instead of frame sized, and are still
+# large enough to amortize the per call overhead of numpy.
+SHADING_TILE_BYTES = 4 * 1024 * 1024
+# Bytes a pixel of a tile takes in `worker`: the normals, frame and float32
+# illuminance, plus the float64 temporaries alive while shading one light
+# (xs, ys, view, light_d, incident, reflection, the per pixel scalars and the
+# intermediate results of the expressions). tracemalloc measures ~212 B.
+SHADING_BYTES_PER_PIXEL = 224
 
 class Buffer(SharedMemoryHandlee):
     __slots__ = ("width", "height") + SharedMemoryHandlee.__slots__
@@ -38,25 +65,26 @@ class Buffer(SharedMemoryHandlee):
 class NormalBuffer(Buffer):
     __slots__ = Buffer.__slots__
     def __init__(self, width, height):
-        super().__init__(width, height, "ddd")
+        # Single precision is plenty for unit vectors and halves the memory
+        super().__init__(width, height, "fff")
     
     def default(self):
         width, height = self.width, self.height
-        struct, data = self._smh_struct, self._smh_data
-        item_size = struct.size
-        for y in range(height):
-            y_ =  pi / 2 + (abs(y % 30*2 - 30) - 30*0.5) * 0.1
-            # y_ =  pi / 2
-            for x in range(width):
-                x_ = x*pi/20
-                v = (
-                    cos(x_)*cos(y_), 
-                    sin(x_)*cos(y_),
-                    -abs(sin(y_))
-                )
-                struct.pack_into(data, 
-                                 (y*width + x)*item_size, 
-                                 *v)
+        normals = self.as_array().reshape(height, width, 3)
+        ys = np.arange(height)
+        y_ = pi / 2 + (np.abs(ys % 30*2 - 30) - 30*0.5) * 0.1
+        # y_ = np.full(height, pi / 2)
+        x_ = np.arange(width)*pi/20
+        cos_y = np.cos(y_)
+        normals[..., 0] = np.outer(cos_y, np.cos(x_))
+        normals[..., 1] = np.outer(cos_y, np.sin(x_))
+        normals[..., 2] = -np.abs(np.sin(y_))[:, None]
+
+@lru_cache
+def _display_format(width: int, height: int) -> bytes:
+    """Format bytes of a whole frame, one %d per byte of a FrameBuffer."""
+    return ((b"\033[48;2;%d;%d;%dm  " * width) + b"\033[0m\n") * height
+
 
 class FrameBuffer(Buffer):
     __slots__ = Buffer.__slots__
@@ -64,31 +92,34 @@ class FrameBuffer(Buffer):
         super().__init__(width, height, 3)
     
     def display(self) -> None:
-        data = self.data
-        width = self.width
-        byte_row_width = width * 3
-        format_str = ("\033[48;2;%d;%d;%dm  " * width) + "\033[0m\n"
-        str_buff = (
-            (format_str % tuple(data[y : y+byte_row_width]))
-            for y in range(0, self.height*byte_row_width, byte_row_width)
-        )
-        print("".join(str_buff), end="")
+        width, height = self.width, self.height
+        # Write the already encoded frame to the binary buffer under stdout,
+        # after whatever was printed before it.
+        frame = (_display_format(width, height)
+                 % tuple(self._smh_data[:width*height*3]))
+        sys.stdout.flush()
+        # Replaced stdout (e.g. a StringIO) may have no binary buffer
+        buffer = getattr(sys.stdout, "buffer", None)
+        if buffer is None:
+            sys.stdout.write(frame.decode())
+            sys.stdout.flush()
+            return
+        buffer.write(frame)
+        buffer.flush()
     
     def default(self) -> None:
-        for i in range(0, len(self), 3):
-            self[i] = 64
-            self[i+1] = 32
-            self[i+2] = 24
+        # One block write instead of one write per byte
+        self._smh_data[:len(self)] = bytes((64, 32, 24)) * (len(self) // 3)
     
     @classmethod
     def from_normal_buffer(cls, normal_buffer: Buffer) -> FrameBuffer:
         width, height = normal_buffer.width, normal_buffer.height
         frame_buffer = cls(width, height)
-        data = frame_buffer._smh_data
-        for i, normal in enumerate(normal_buffer):
-            data[i*3 + 0] = int((1 - normal[0]) * 255 / 2)
-            data[i*3 + 1] = int((1 - normal[1]) * 255 / 2)
-            data[i*3 + 2] = int((1 - normal[2]) * 255 / 2)
+        normals = normal_buffer.as_array()
+        colors = frame_buffer.as_array().reshape(-1, 3)
+        buffer = (1 - normals) * 255 / 2
+        np.clip(buffer, 0, 255, out=buffer)
+        colors[:] = buffer
         return frame_buffer
 
 
@@ -107,68 +138,234 @@ class Camera:
     y: float = 15
     z: float = 0
 
+def lights_to_arrays(lights: Iterable[Light]) -> tuple[np.ndarray, np.ndarray]:
+    """Return the positions and colors of `lights` as two (L, 3) arrays."""
+    lights = tuple(lights)
+    lights_xyz = np.array([(light.x, light.y, light.z) for light in lights],
+                          dtype=np.float64).reshape(-1, 3)
+    lights_rgb = np.array([(light.r, light.g, light.b) for light in lights],
+                          dtype=np.float64).reshape(-1, 3)
+    return lights_xyz, lights_rgb
+
 def worker(frame_buffer: FrameBuffer, normal_buffer: NormalBuffer, 
-           lights: Iterable[Light], camera: Camera, 
+           lights_xyz: np.ndarray, lights_rgb: np.ndarray, camera: Camera, 
            process_no: int | None = None, process_num: int | None = None):
     width, height = normal_buffer.width, normal_buffer.height
     if process_no is not None and process_num is not None:
-        vertical_range = range(height * process_no // process_num, 
-                               height * (process_no+1) // process_num)
+        y0 = height * process_no // process_num
+        y1 = height * (process_no+1) // process_num
     else:
-        vertical_range = range(height)
-    frame_data = frame_buffer._smh_data
-    normals_struct = normal_buffer._smh_struct
-    normals_item_size = normals_struct.size
-    normals_data = normal_buffer._smh_data
+        y0, y1 = 0, height
+    if y0 == y1:
+        return
+    # Views of the shared memory, no copy. as_array caches them per process
+    # and they are dropped in __exit__, __del__ or at exit by _cleanup.
+    all_normals = normal_buffer.as_array().reshape(height, width, 3)
+    all_frame = frame_buffer.as_array().reshape(height, width, 3)
     z = 10
-    k_d, k_s, shininess = 1.0, 0.2, 1
-    for y in vertical_range:
-        for x in range(width):
-            normal_x, normal_y, normal_z = normals_struct.unpack_from(normals_data, normals_item_size*(y*width + x))
-            illuminance_r, illuminance_g, illuminance_b = 0, 0, 0
-            for light in lights:
-                light_dx = light.x-x
-                light_dy = light.y-y
-                light_dz = light.z-z
-                # fragment to camera distance is disgarded
-                dist_sqr = (light_dx*light_dx
-                            + light_dy*light_dy
-                            + light_dz*light_dz)
-                distance = dist_sqr**0.5
-                dist_coef = 1 / (1 + 0.1*distance + 0.01*dist_sqr)
-                
-                inv_distance = 1 / distance
-                incident_x = light_dx * inv_distance
-                incident_y = light_dy * inv_distance
-                incident_z = light_dz * inv_distance
-
-                normal_coef = (2*normal_x*incident_x
-                               + 2*normal_y*incident_y
-                               + 2*normal_z*incident_z)
-                reflection_x = normal_x*normal_coef - incident_x
-                reflection_y = normal_y*normal_coef - incident_y
-                reflection_z = normal_z*normal_coef - incident_z
-                intensity = (
-                    k_d * (
-                        normal_x*incident_x
-                        + normal_y*incident_y
-                        + normal_z*incident_z
-                    )
-                    + k_s * max(
-                        (camera.x - x)*reflection_x
-                        + (camera.y - y)*reflection_y
-                        + (camera.z - z)*reflection_z,
-                        0
-                    )**shininess
-                ) * dist_coef
-                if intensity > 0:
-                    illuminance_r += intensity * light.r
-                    illuminance_g += intensity * light.g
-                    illuminance_b += intensity * light.b
-            address = (y*width + x)*3
-            frame_data[address+0] = r if (r:=round((illuminance_r+0.5)*frame_data[address+0])) < 255 else 255
-            frame_data[address+1] = g if (g:=round((illuminance_g+0.5)*frame_data[address+1])) < 255 else 255
-            frame_data[address+2] = b if (b:=round((illuminance_b+0.5)*frame_data[address+2])) < 255 else 255
+    # shininess is 1, so the specular term is used as is
+    k_d, k_s = 1.0, 0.2
+    # All the lights are applied to a tile of rows before moving on to the
+    # next one, so that the tile and its temporaries stay in cache across
+    # the lights.
+    tile_rows = max(1, SHADING_TILE_BYTES // (width * SHADING_BYTES_PER_PIXEL))
+    for tile_y0 in range(y0, y1, tile_rows):
+        tile_y1 = min(tile_y0 + tile_rows, y1)
+        normals = all_normals[tile_y0:tile_y1]
+        frame = all_frame[tile_y0:tile_y1]
+        xs, ys = np.meshgrid(np.arange(width, dtype=np.float64),
+                             np.arange(tile_y0, tile_y1, dtype=np.float64))
+        # fragment to camera
+        view = np.stack((camera.x - xs, camera.y - ys, 
+                         np.full_like(xs, camera.z - z)), axis=-1)
+        illuminance = np.zeros(frame.shape, dtype=np.float32)
+        for i in range(lights_xyz.shape[0]):
+            # fragment to camera distance is disgarded
+            light_d = np.stack((lights_xyz[i, 0] - xs, lights_xyz[i, 1] - ys, 
+                                np.full_like(xs, lights_xyz[i, 2] - z)), 
+                               axis=-1)
+            dist_sqr = np.einsum("hwc,hwc->hw", light_d, light_d)
+            distance = np.sqrt(dist_sqr)
+            inv_distance = np.reciprocal(distance)
+            dist_coef = 1 + 0.1*distance
+            dist_coef += 0.01*dist_sqr
+            np.reciprocal(dist_coef, out=dist_coef)
+            incident = light_d * inv_distance[..., None]
+
+            diffuse = np.einsum("hwc,hwc->hw", normals, incident)
+            reflection = normals * (2*diffuse)[..., None] - incident
+            specular = np.maximum(np.einsum("hwc,hwc->hw", view, reflection), 
+                                  0)
+            intensity = k_d*diffuse
+            intensity += k_s*specular
+            intensity *= dist_coef
+            np.maximum(intensity, 0, out=intensity)
+            illuminance += intensity[..., None] * lights_rgb[i]
+        # illuminance is never negative, so only the upper bound needs clipping
+        illuminance += 0.5
+        illuminance *= frame
+        np.rint(illuminance, out=illuminance)
+        np.minimum(illuminance, 255, out=illuminance)
+        frame[...] = illuminance
+
+
+# Buffers of a pool worker process, set once by `_worker_init` so that they
+# are not sent again for every frame.
+_frame_buffer: FrameBuffer | None = None
+_normal_buffer: NormalBuffer | None = None
+
+def _worker_init(frame_buffer: FrameBuffer, normal_buffer: NormalBuffer):
+    global _frame_buffer, _normal_buffer
+    _frame_buffer, _normal_buffer = frame_buffer, normal_buffer
+
+def worker_rows(lights_xyz: np.ndarray, lights_rgb: np.ndarray, 
+                camera: Camera, process_no: int, process_num: int):
+    worker(_frame_buffer, _normal_buffer, lights_xyz, lights_rgb, camera, 
+           process_no, process_num)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, boundscheck=False)
+    def shade_kernel(normals, frame, lights_xyz, lights_rgb, cam, y0, y1):
+        """
+        Same shading as `worker`, fused into one pass over the rows 
+        [y0, y1) and spread over the numba threads.
+        """
+        width = normals.shape[1]
+        light_num = lights_xyz.shape[0]
+        z = 10.0
+        k_d, k_s = 1.0, 0.2
+        for y in prange(y0, y1):
+            for x in range(width):
+                normal_x = normals[y, x, 0]
+                normal_y = normals[y, x, 1]
+                normal_z = normals[y, x, 2]
+                view_x, view_y, view_z = cam[0] - x, cam[1] - y, cam[2] - z
+                illuminance_r, illuminance_g, illuminance_b = 0.0, 0.0, 0.0
+                for i in range(light_num):
+                    light_dx = lights_xyz[i, 0] - x
+                    light_dy = lights_xyz[i, 1] - y
+                    light_dz = lights_xyz[i, 2] - z
+                    dist_sqr = (light_dx*light_dx
+                                + light_dy*light_dy
+                                + light_dz*light_dz)
+                    distance = np.sqrt(dist_sqr)
+                    inv_distance = 1.0 / distance
+                    dist_coef = 1.0 / (1.0 + 0.1*distance + 0.01*dist_sqr)
+                    incident_x = light_dx * inv_distance
+                    incident_y = light_dy * inv_distance
+                    incident_z = light_dz * inv_distance
+                    diffuse = (normal_x*incident_x
+                               + normal_y*incident_y
+                               + normal_z*incident_z)
+                    normal_coef = 2*diffuse
+                    specular = (view_x*(normal_x*normal_coef - incident_x)
+                                + view_y*(normal_y*normal_coef - incident_y)
+                                + view_z*(normal_z*normal_coef - incident_z))
+                    intensity = (k_d*diffuse + k_s*max(specular, 0.0))*dist_coef
+                    if intensity > 0:
+                        illuminance_r += intensity * lights_rgb[i, 0]
+                        illuminance_g += intensity * lights_rgb[i, 1]
+                        illuminance_b += intensity * lights_rgb[i, 2]
+                frame[y, x, 0] = min(255, round((illuminance_r+0.5)*frame[y, x, 0]))
+                frame[y, x, 1] = min(255, round((illuminance_g+0.5)*frame[y, x, 1]))
+                frame[y, x, 2] = min(255, round((illuminance_b+0.5)*frame[y, x, 2]))
+
+
+def worker_numba(frame_buffer: FrameBuffer, normal_buffer: NormalBuffer, 
+                 lights_xyz: np.ndarray, lights_rgb: np.ndarray, 
+                 camera: Camera, y0: int = 0, y1: int | None = None):
+    width, height = normal_buffer.width, normal_buffer.height
+    normals = normal_buffer.as_array().reshape(height, width, 3)
+    frame = frame_buffer.as_array().reshape(height, width, 3)
+    cam = np.array((camera.x, camera.y, camera.z), dtype=np.float64)
+    shade_kernel(normals, frame, lights_xyz, lights_rgb, cam, 
+                 y0, height if y1 is None else y1)
+
+
+if cp is not None:
+    # Experimental and not yet run on a GPU.
+    # Same shading as `shade_kernel`, one CUDA thread per pixel.
+    _shade_cuda_kernel = cp.RawKernel(r"""
+    extern "C" __global__
+    void shade(const float* normals, unsigned char* frame,
+               const double* lights_xyz, const double* lights_rgb, 
+               int light_num, double cam_x, double cam_y, double cam_z,
+               int width, int height) {
+        int x = blockIdx.x*blockDim.x + threadIdx.x;
+        int y = blockIdx.y*blockDim.y + threadIdx.y;
+        if (x >= width || y >= height) return;
+        int address = (y*width + x)*3;
+        const double z = 10.0, k_d = 1.0, k_s = 0.2;
+        double normal_x = normals[address + 0];
+        double normal_y = normals[address + 1];
+        double normal_z = normals[address + 2];
+        double view_x = cam_x - x, view_y = cam_y - y, view_z = cam_z - z;
+        double illuminance_r = 0.0, illuminance_g = 0.0, illuminance_b = 0.0;
+        for (int i = 0; i < light_num; ++i) {
+            double light_dx = lights_xyz[i*3 + 0] - x;
+            double light_dy = lights_xyz[i*3 + 1] - y;
+            double light_dz = lights_xyz[i*3 + 2] - z;
+            double dist_sqr = (light_dx*light_dx + light_dy*light_dy 
+                               + light_dz*light_dz);
+            double distance = sqrt(dist_sqr);
+            double inv_distance = 1.0 / distance;
+            double dist_coef = 1.0 / (1.0 + 0.1*distance + 0.01*dist_sqr);
+            double incident_x = light_dx * inv_distance;
+            double incident_y = light_dy * inv_distance;
+            double incident_z = light_dz * inv_distance;
+            double diffuse = (normal_x*incident_x + normal_y*incident_y 
+                              + normal_z*incident_z);
+            double normal_coef = 2*diffuse;
+            double specular = (view_x*(normal_x*normal_coef - incident_x)
+                               + view_y*(normal_y*normal_coef - incident_y)
+                               + view_z*(normal_z*normal_coef - incident_z));
+            double intensity = (k_d*diffuse + k_s*fmax(specular, 0.0))*dist_coef;
+            if (intensity > 0) {
+                illuminance_r += intensity * lights_rgb[i*3 + 0];
+                illuminance_g += intensity * lights_rgb[i*3 + 1];
+                illuminance_b += intensity * lights_rgb[i*3 + 2];
+            }
+        }
+        frame[address + 0] = (unsigned char)fmin(
+            255.0, rint((illuminance_r + 0.5)*frame[address + 0]));
+        frame[address + 1] = (unsigned char)fmin(
+            255.0, rint((illuminance_g + 0.5)*frame[address + 1]));
+        frame[address + 2] = (unsigned char)fmin(
+            255.0, rint((illuminance_b + 0.5)*frame[address + 2]));
+    }
+    """, "shade")
+
+
+# Normals on the device by shared memory name, uploaded once since they 
+# never change after `NormalBuffer.default`
+_normals_gpu = {}
+
+
+def worker_cuda(frame_buffer: FrameBuffer, normal_buffer: NormalBuffer, 
+                lights_xyz: np.ndarray, lights_rgb: np.ndarray, 
+                camera: Camera):
+    width, height = normal_buffer.width, normal_buffer.height
+    frame = frame_buffer.as_array().reshape(height, width, 3)
+    normals_gpu = _normals_gpu.get(normal_buffer._smh_name)
+    if normals_gpu is None:
+        normals_gpu = cp.asarray(normal_buffer.as_array(), dtype=cp.float32)
+        _normals_gpu[normal_buffer._smh_name] = normals_gpu
+    frame_gpu = cp.asarray(frame)
+    block = (16, 16)
+    grid = ((width + block[0] - 1) // block[0], 
+            (height + block[1] - 1) // block[1])
+    _shade_cuda_kernel(
+        grid, block,
+        (normals_gpu, frame_gpu, 
+         cp.asarray(lights_xyz, dtype=cp.float64), 
+         cp.asarray(lights_rgb, dtype=cp.float64), 
+         np.int32(lights_xyz.shape[0]), 
+         np.float64(camera.x), np.float64(camera.y), np.float64(camera.z),
+         np.int32(width), np.int32(height))
+    )
+    # Copy straight back into the shared memory
+    cp.asnumpy(frame_gpu, out=frame)
 
     
 
@@ -180,6 +377,15 @@ if __name__ == "__main__":
     normal_buffer = NormalBuffer(width, height)
     normal_buffer.default()
     FrameBuffer.from_normal_buffer(normal_buffer).display()
+    if not USE_CUDA and USE_NUMBA:
+        set_num_threads(cpu_count())
+        # Compile before the first frame by shading an empty row range
+        worker_numba(frame_buffer, normal_buffer, 
+                     *lights_to_arrays((Light(),)), Camera(), 0, 0)
+    elif not USE_CUDA and USE_MULTI_PROCESSING:
+        process_num = cpu_count()
+        pool = Pool(process_num, initializer=_worker_init, 
+                    initargs=(frame_buffer, normal_buffer))
     t = 0
     print("\033[?25l")
     start = time()
@@ -188,16 +394,20 @@ if __name__ == "__main__":
         y = x*height/width
 
         y = abs(t//(width / 3)%(height*2) - height)
-        if USE_MULTI_PROCESSING:
-            processes = [Process(target=worker, 
-                                 args=(frame_buffer, normal_buffer, 
-                                       (Light(x, y, 5),), Camera(width//2, height//2), 
-                                       i, cpu_count()))
-                    for i in range(cpu_count())]
-            for process in processes: process.start()
-            for process in processes: process.join()
+        lights_xyz, lights_rgb = lights_to_arrays((Light(x, y, 5),))
+        camera = Camera(width//2, height//2)
+        if USE_CUDA:
+            worker_cuda(frame_buffer, normal_buffer, lights_xyz, lights_rgb, 
+                        camera)
+        elif USE_NUMBA:
+            worker_numba(frame_buffer, normal_buffer, lights_xyz, lights_rgb, 
+                         camera)
+        elif USE_MULTI_PROCESSING:
+            pool.starmap(worker_rows, 
+                         [(lights_xyz, lights_rgb, camera, i, process_num)
+                          for i in range(process_num)])
         else:
-            worker(frame_buffer, normal_buffer, (Light(x, y, 5),), Camera(width//2, height//2))
+            worker(frame_buffer, normal_buffer, lights_xyz, lights_rgb, camera)
         frame_buffer.display()
         print(f"{x=:<4} {y=:<4} {width=:<4} {height=:<4} FPS:{1 / (time() - start):.3f}")
         start = time()
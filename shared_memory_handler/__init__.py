@@ -1,4 +1,5 @@
 from .shared_memory_handler import add_shared_memory, get_memory_view
+from .shared_memory_handler import get_memory_view_cast
 from .shared_memory_handler import SharedMemoryHandlee
 
 from .shared_memory_handler import _get_shared_memory
@@ -1,25 +1,73 @@
 from __future__ import annotations
 from collections.abc import Iterator
+from itertools import islice
+from math import prod
 from typing import Final
 from multiprocessing.shared_memory import SharedMemory
 from multiprocessing import current_process
-from struct import Struct
-from uuid import uuid4
+from struct import Struct, calcsize
+from re import compile as re_compile
+from secrets import token_urlsafe
+from os import getpid
 from atexit import register
-from signal import signal, SIGINT, SIGTERM, SIGABRT # TODO Catch more signals
+from signal import signal, getsignal, default_int_handler, SIG_DFL
+from signal import SIGINT, SIGTERM, SIGABRT # TODO Catch more signals
+try:
+    from os import register_at_fork
+except ImportError:
+    # Not available on platforms without fork
+    register_at_fork = None
 from abc import ABC
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 MAX_NAME_LENGTH: Final = 30
 
+# struct format characters that have a fixed size numpy counterpart.
+_NUMPY_DTYPE_MAP: Final = {
+    "?": "bool",
+    "b": "int8", "B": "uint8",
+    "h": "int16", "H": "uint16",
+    "i": "int32", "I": "uint32",
+    "q": "int64", "Q": "uint64",
+    "e": "float16", "f": "float32", "d": "float64",
+}
+# struct byte order characters to numpy byte order characters
+_NUMPY_BYTE_ORDER_MAP: Final = {"@": "=", "=": "=", "<": "<", ">": ">", "!": ">"}
+_STRUCT_FIELD_PATTERN: Final = re_compile(r"(\d*)(\D)")
+
 # SharedMemory created in other processes.
 global_shared_memory_objects: dict[str, SharedMemory] = {}
 # SharedMemory created in the current process. 
 # They will be unlinked once the current process ends.
 local_shared_memory_objects: dict[str, SharedMemory] = {}
+# pid of the process that created each SharedMemory in
+# `local_shared_memory_objects`. Forked children inherit the dict, but must
+# not unlink the SharedMemory of their parent.
+_local_shared_memory_pids: dict[str, int] = {}
+# numpy views of the SharedMemory in the current process, cached by
+# `SharedMemoryHandlee.as_ndarray` per name, then per (dtype, shape).
+# They must be dropped before the SharedMemory is closed.
+_ndarray_views: dict[str, dict[tuple, np.ndarray]] = {}
+# Cast memoryviews of the SharedMemory in the current process, cached by
+# `get_memory_view_cast` per name, then per (format, shape).
+# They must be released before the SharedMemory is closed.
+_cast_memory_views: dict[str, dict[tuple, memoryview]] = {}
+# Formats `memoryview.cast` accepts among the struct format characters.
+_CASTABLE_FORMATS: Final = frozenset("bBc?hHiIlLqQnNefdP")
 
 def _cleanup() -> None:
     """Clean up shared memory objects."""
-    for shared_memory in global_shared_memory_objects.values():
+    # Iterate over snapshots, as a signal may interrupt a running cleanup and
+    # start another one.
+    _ndarray_views.clear()
+    for views in list(_cast_memory_views.values()):
+        for view in list(views.values()):
+            view.release()
+    _cast_memory_views.clear()
+    for shared_memory in list(global_shared_memory_objects.values()):
         try:
             if shared_memory:
                 shared_memory.close()
@@ -28,11 +76,13 @@ def _cleanup() -> None:
         except Exception as e:
             print("Error closing shared memory created outside the current "
                   f"process '{current_process().name}': {e}")
-    for shared_memory in local_shared_memory_objects.values():
+    pid = getpid()
+    for name, shared_memory in list(local_shared_memory_objects.items()):
         try:
             if shared_memory:
                 shared_memory.close()
-                shared_memory.unlink()
+                if _local_shared_memory_pids.get(name) == pid:
+                    shared_memory.unlink()
         except FileNotFoundError:
             pass
         except Exception as e:
@@ -44,22 +94,61 @@ def _signal_handler(signum, frame) -> None:
     _cleanup()
     exit()
 
+def _restore_default_signal_handlers() -> None:
+    """Undo the signal handlers of this module in a forked child."""
+    for signum, default in ((SIGINT, default_int_handler), 
+                            (SIGTERM, SIG_DFL), 
+                            (SIGABRT, SIG_DFL)):
+        if getsignal(signum) is _signal_handler:
+            signal(signum, default)
+
 register(_cleanup)
-signal(SIGINT, _signal_handler)
-signal(SIGTERM, _signal_handler)
-signal(SIGABRT, _signal_handler)
+# Child processes, e.g. pool workers, only rely on atexit, so that signals 
+# meant for their parent process are handled by multiprocessing as usual.
+# Spawned children are skipped here, forked children inherit the handlers 
+# and have them removed right after the fork.
+if current_process().name == "MainProcess":
+    signal(SIGINT, _signal_handler)
+    signal(SIGTERM, _signal_handler)
+    signal(SIGABRT, _signal_handler)
+    if register_at_fork is not None:
+        register_at_fork(after_in_child=_restore_default_signal_handlers)
+
+
+def _parse_homogeneous_format(format: str) -> tuple[str, str, int] | None:
+    """
+    Parse a struct format made of a single repeated type, e.g. 'fff' or '3f'.
+
+    Return (byte order, type character, field count), or None if the format
+    mixes types or contains padding, strings, etc.
+    """
+    format = "".join(format.split())
+    byte_order = "@"
+    if format and format[0] in _NUMPY_BYTE_ORDER_MAP:
+        byte_order, format = format[0], format[1:]
+    char, count = None, 0
+    end = 0
+    for match in _STRUCT_FIELD_PATTERN.finditer(format):
+        if match.start() != end:
+            return None
+        end = match.end()
+        repeat, field_char = match.groups()
+        if char is None:
+            char = field_char
+        elif field_char != char:
+            return None
+        count += int(repeat) if repeat else 1
+    if char is None or end != len(format) or count == 0:
+        return None
+    return byte_order, char, count
 
 
 def _random_name() -> str:
-    LOOKUP = "0123456789_ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
-    process_name = current_process().name
-    rest_length = MAX_NAME_LENGTH - len(process_name)
-    n = uuid4().int
-    random_part = [None] * (rest_length)
-    for i in range(rest_length):
-        n, r = divmod(n, 64)
-        random_part[i] = LOOKUP[r]
-    return f"{process_name}{"".join(random_part)}"
+    # The pid is looked up on every call rather than cached because forked
+    # processes inherit the module state of their parent.
+    prefix = f"{getpid()}_"
+    rest_length = MAX_NAME_LENGTH - len(prefix)
+    return f"{prefix}{token_urlsafe(rest_length)[:rest_length]}"
 
 
 def add_shared_memory(size: int, name: str | None = None) -> str:
@@ -69,20 +158,21 @@ def add_shared_memory(size: int, name: str | None = None) -> str:
     This object will not out-live the process it is created in.
 
     Do not specify name unless you are very sure there won't be a collision.
-    By default, the name is generated with uuid.uuid4.
+    By default, the name is the pid followed by secrets.token_urlsafe.
     """
     if size <= 0:
         raise ValueError("Size must be positive")
-    process_name = current_process().name
     name = _random_name()
     # It is extremely rare, but we can easily solve the problem cause by such
-    # name collision
-    while name in global_shared_memory_objects or name in local_shared_memory_objects:
+    # name collision. Random names start with the pid, so only the names
+    # created in the current process need to be checked.
+    while name in local_shared_memory_objects:
         name = _random_name()
 
     try:
         shm = SharedMemory(name, create=True, size=size, track=False)
         local_shared_memory_objects[name] = shm
+        _local_shared_memory_pids[name] = getpid()
         return shm.name
     # Two possible causes:
     # 1. A shared memory object created before was not cleaned up when the 
@@ -99,7 +189,7 @@ def add_shared_memory(size: int, name: str | None = None) -> str:
         shm = SharedMemory(name, create=False, track=False)
         shm.close()
         shm.unlink()
-        add_shared_memory(size, name)
+        return add_shared_memory(size, name)
     except Exception as e:
         try:
             if shm:
@@ -134,23 +224,41 @@ def get_memory_view(name: str) -> memoryview:
     shm.unlink()
     ```
     """
-    if name in local_shared_memory_objects:
-        return local_shared_memory_objects[name].buf
-    elif name in global_shared_memory_objects:
-        return global_shared_memory_objects[name].buf
-    else:
-        # The SharedMemory is not created within the current process
-        # because all SharedMemory created in the current process are in
-        # `local_shared_memory_objects`
-        try:
-            shm = SharedMemory(name, create=False, track=False)
-            global_shared_memory_objects[name] = shm
-            return shm.buf
-        except FileNotFoundError as e:
-            raise FileNotFoundError(
-                f"SharedMemory with name {name} has not been created"
-                f" or has already been destroyed.\n{e}"
-            )
+    return _get_shared_memory(name).buf
+
+def get_memory_view_cast(name: str, format: str, 
+                         shape: tuple[int, ...] | None = None) -> memoryview:
+    """
+    Get a memory view of a shared memory object cast to `format`.
+
+    Unlike the memory view of `get_memory_view`, indexing the returned one
+    gives values of `format` directly, e.g. floats for 'f'. `format` must 
+    be a single native struct format character. Without `shape`, the view
+    is 1-D and covers as many whole items as fit.
+
+    The view is cached per process and released in 
+    `SharedMemoryHandlee.__exit__`, `SharedMemoryHandlee.__del__` and at
+    exit, after which it can no longer be used.
+    """
+    views = _cast_memory_views.setdefault(name, {})
+    view = views.get((format, shape))
+    if view is None:
+        data = get_memory_view(name)
+        item_size = calcsize(format)
+        count = prod(shape) if shape else len(data) // item_size
+        size = count * item_size
+        # The slice is only needed to match the size for the cast, and can be
+        # released right away.
+        with data[:size] as sliced:
+            view = sliced.cast(format, shape) if shape else sliced.cast(format)
+        views[(format, shape)] = view
+    return view
+
+def _release_views(name: str) -> None:
+    """Drop the cached views of a shared memory object before closing it."""
+    _ndarray_views.pop(name, None)
+    for view in _cast_memory_views.pop(name, {}).values():
+        view.release()
 
 def _get_shared_memory(name: str) -> SharedMemory:
     """
@@ -161,23 +269,25 @@ def _get_shared_memory(name: str) -> SharedMemory:
     Raise FileNotFoundError if the shared memory object is not created or has
     been unlinked
     """
-    if name in local_shared_memory_objects:
-        return local_shared_memory_objects[name]
-    elif name in global_shared_memory_objects:
-        return global_shared_memory_objects[name]
-    else:
-        # The SharedMemory is not created within the current process
-        # because all SharedMemory created in the current process are in
-        # `local_shared_memory_objects`
-        try:
-            shm = SharedMemory(name, create=False, track=False)
-            global_shared_memory_objects[name] = shm
-            return shm
-        except FileNotFoundError as e:
-            raise FileNotFoundError(
-                f"SharedMemory with name {name} has not been created"
-                f" or has already been destroyed.\n{e}"
-            )
+    # SharedMemory attached once stays in `global_shared_memory_objects` for
+    # the lifetime of the process, so objects unpickled again and again, e.g.
+    # by the same pool workers, only call shm_open the first time.
+    shm = local_shared_memory_objects.get(name)
+    if shm is None:
+        shm = global_shared_memory_objects.get(name)
+    if shm is not None:
+        return shm
+    # The SharedMemory is not created within the current process
+    # because all SharedMemory created in the current process are in
+    # `local_shared_memory_objects`
+    try:
+        shm = SharedMemory(name, create=False, track=False)
+    except FileNotFoundError as e:
+        raise FileNotFoundError(
+            f"SharedMemory with name {name} has not been created"
+            f" or has already been destroyed.\n{e}"
+        )
+    return global_shared_memory_objects.setdefault(name, shm)
 
 
 class SharedMemoryHandlee(ABC):
@@ -223,6 +333,8 @@ class SharedMemoryHandlee(ABC):
         size: Returns the size of SharedMemory.
         __len__: Returns the length of the shared memory object.
         __iter__: Returns an iterator over the shared memory object.
+        as_ndarray: Returns a cached numpy view with a given dtype and shape.
+        as_array: Returns a numpy view of the shared memory object.
         get_at: Returns the value at a specific index.
         set_at: Sets the value at a specific index.
         __getitem__: Magic method for getting the value at a specific index.
@@ -235,13 +347,15 @@ class SharedMemoryHandlee(ABC):
         __getstate__: Abstract magic method
         __setstate__: Abstract magic method
     """
-    __slots__ = ("_smh_name", "_smh_length", "_smh_struct", "_smh_data")
+    __slots__ = ("_smh_name", "_smh_length", "_smh_struct", "_smh_data",
+                 "_smh_item_size", "_smh_pack_into", "_smh_unpack_from",
+                 "_smh_iter", "_smh_data_cast")
     def __init__(self, length: int, struct: str | Struct | None = None):
         """
         Initiate a multiprocessing friendly object.
 
-        If no name is provided, a random name in hex with a length of 30 will
-        be generated with uuid.uuid4.
+        If no name is provided, a random name with a length of 30 will be
+        generated from the pid and secrets.token_urlsafe.
 
         When `struct` is left as None, it will behave more like a simple 
         memoryview.
@@ -257,6 +371,38 @@ class SharedMemoryHandlee(ABC):
         self._smh_name = add_shared_memory(size=size)
         self._smh_length = length
         self._smh_data = get_memory_view(self._smh_name)
+        self._smh_bind()
+
+    def _smh_bind(self) -> None:
+        """Cache the struct methods used by the [] operator and __iter__."""
+        struct = self._smh_struct
+        data, length = self._smh_data, self._smh_length
+        self._smh_data_cast = None
+        if struct:
+            parsed = _parse_homogeneous_format(struct.format)
+            # Indexing a cast memoryview beats unpack_from for a single field
+            # but not for several, where it needs one lookup per field.
+            if (parsed and parsed[0] == "@" and parsed[2] == 1 
+                    and parsed[1] in _CASTABLE_FORMATS):
+                self._smh_data_cast = get_memory_view_cast(
+                    self._smh_name, parsed[1], (length,)
+                )
+            item_size = struct.size
+            unpack_from = struct.unpack_from
+            self._smh_item_size = item_size
+            self._smh_pack_into = struct.pack_into
+            self._smh_unpack_from = unpack_from
+            # unpack_from reads in place. Slicing data instead would create
+            # memoryviews that may outlive the SharedMemory.
+            self._smh_iter = lambda: (
+                unpack_from(data, offset) 
+                for offset in range(0, length*item_size, item_size)
+            )
+        else:
+            self._smh_item_size = 1
+            self._smh_pack_into = None
+            self._smh_unpack_from = None
+            self._smh_iter = lambda: islice(data, length)
     
     @property
     def data(self) -> memoryview:
@@ -274,22 +420,57 @@ class SharedMemoryHandlee(ABC):
         return self._smh_length
     
     def __iter__(self) -> Iterator:
-        struct = self._smh_struct
-        data = self._smh_data
-        if struct:
-            # This method uses a reference to a slice of _smh_data, which can
-            # cause a BufferError if the program terminates before the
-            # iterator is deleted.
-            # return struct.iter_unpack(
-            #     self._smh_data[:struct.size * self._smh_length]
-            # )
-            item_size = struct.size
-            size = self._smh_length * item_size
-            return (struct.unpack(data[i:i+item_size])
-                    for i in range(0, size, item_size))
-        else:
-            return (self._smh_data[i] for i in range(self._smh_length))
+        return self._smh_iter()
     
+    def as_ndarray(self, dtype, shape: int | tuple[int, ...]):
+        """
+        Return a numpy view of the data with the given dtype and shape.
+
+        Views are cached per process, so repeated calls return the same 
+        array. The cache is dropped in __exit__ and __del__ before the 
+        SharedMemory is closed, but other references to the returned view
+        must still be deleted by the caller, just like .data.
+        """
+        if np is None:
+            raise ImportError("numpy is required for as_ndarray")
+        dtype = np.dtype(dtype)
+        shape = (shape,) if isinstance(shape, int) else tuple(shape)
+        views = _ndarray_views.setdefault(self._smh_name, {})
+        view = views.get((dtype, shape))
+        if view is None:
+            view = np.frombuffer(self._smh_data, dtype=dtype, 
+                                 count=prod(shape)).reshape(shape)
+            views[(dtype, shape)] = view
+        return view
+
+    def as_array(self):
+        """
+        Return the data as a numpy array without copying.
+
+        For struct formats made of a single repeated numeric type, e.g. 'd' or
+        'fff', the result is a view of shape (length, number of fields), so
+        writes go straight to the shared memory. Without a struct, it is a 
+        uint8 view of shape (length,). Other formats fall back to a list of 
+        unpacked tuples, which is a copy.
+
+        Views come from `as_ndarray`, so the same cache rules apply.
+        """
+        if np is None:
+            raise ImportError("numpy is required for as_array")
+        struct = self._smh_struct
+        length = self._smh_length
+        if struct is None:
+            return self.as_ndarray(np.uint8, length)
+        parsed = _parse_homogeneous_format(struct.format)
+        if parsed is None or parsed[1] not in _NUMPY_DTYPE_MAP:
+            with self._smh_data[:struct.size*length] as data:
+                return list(struct.iter_unpack(data))
+        byte_order, char, count = parsed
+        dtype = np.dtype(_NUMPY_DTYPE_MAP[char]).newbyteorder(
+            _NUMPY_BYTE_ORDER_MAP[byte_order]
+        )
+        return self.as_ndarray(dtype, (length, count))
+
     def get_at(self, index: int):
         """
         Non-magic method alternative to __getitem__
@@ -300,16 +481,14 @@ class SharedMemoryHandlee(ABC):
         """
         length = self._smh_length
         if index < 0:
-            index = length - index
+            index += length
         if not (0 <= index < length):
             raise IndexError(f"Index out of range.")
         
-        struct = self._smh_struct
-        if struct:
-            return (struct.unpack_from(self._smh_data, struct.size*index)
-                    if struct else self._smh_data[index])
-        else:
-            return self._smh_data[index]
+        unpack_from = self._smh_unpack_from
+        if unpack_from:
+            return unpack_from(self._smh_data, self._smh_item_size*index)
+        return self._smh_data[index]
     
     def set_at(self, index: int, values):
         """
@@ -321,20 +500,37 @@ class SharedMemoryHandlee(ABC):
         """
         length = self._smh_length
         if index < 0:
-            index = length - index
+            index += length
         if not (0 <= index < length):
             raise IndexError(f"Index out of range.")
         
-        struct = self._smh_struct
-        if struct:
-            struct.pack_into(self._smh_data, struct.size*index, *values)
+        pack_into = self._smh_pack_into
+        if pack_into:
+            pack_into(self._smh_data, self._smh_item_size*index, *values)
         else:
             self._smh_data[index] = values
 
     def __getitem__(self, index) -> tuple | bytes:
+        # Skip get_at for in-range int indices, which is the common case
+        if isinstance(index, int) and 0 <= index < self._smh_length:
+            data_cast = self._smh_data_cast
+            if data_cast is not None:
+                return (data_cast[index],)
+            unpack_from = self._smh_unpack_from
+            if unpack_from:
+                return unpack_from(self._smh_data, self._smh_item_size*index)
+            return self._smh_data[index]
         return self.get_at(index)
     
     def __setitem__(self, index, *values) -> None:
+        if isinstance(index, int) and 0 <= index < self._smh_length:
+            pack_into = self._smh_pack_into
+            if pack_into:
+                pack_into(self._smh_data, self._smh_item_size*index, 
+                          *values[0])
+            else:
+                self._smh_data[index] = values[0]
+            return
         self.set_at(index, *values)
 
     def __enter__(self) -> SharedMemoryHandlee:
@@ -342,15 +538,18 @@ class SharedMemoryHandlee(ABC):
     
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         name = self._smh_name
+        _release_views(name)
         shm = _get_shared_memory(name)
         shm.close()
         shm.unlink()
         del local_shared_memory_objects[name]
+        _local_shared_memory_pids.pop(name, None)
     
     def __del__(self) -> None:
         # FIXME
         # Somehow in debug mode, close will become None sometimes which leads
         # to an ignored Error: 'TypeError: 'NoneType' object is not callable'
+        _release_views(self._smh_name)
         shm = _get_shared_memory(self._smh_name)
         shm.close()
     
@@ -366,6 +565,7 @@ class SharedMemoryHandlee(ABC):
         self._smh_length = state["length"]
         self._smh_struct = Struct(state["struct"]) if state["struct"] else None
         self._smh_data = get_memory_view(self._smh_name)
+        self._smh_bind()
     
     def __getstate__(self) -> dict:
         return self.get_state()
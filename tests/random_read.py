@@ -1,5 +1,5 @@
 
-from shared_memory_handler import SharedMemoryHandlee
+from shared_memory_handler import SharedMemoryHandlee, get_memory_view_cast
 from dataclasses import dataclass
 from random import sample, seed, randint, random
 from math import sin, cos, pi
@@ -70,6 +70,7 @@ for i in range(N):
 shm_bbb_data = shm_bbb.data
 shm_bbb_struct = shm_bbb.struct
 shm_bbb_struct_size = shm_bbb_struct.size
+shm_bbb_array = shm_bbb.as_array()
 ###############################################################
 print(
     "builtin_tuple_color24",
@@ -92,6 +93,23 @@ print(
         globals=globals(),
     ) - forloop_overhead,
 )
+print(
+    "shm_bbb_array",
+    timeit(
+        "for i in order:\n"
+        " color = shm_bbb_array[i]\n",
+        number=M,
+        globals=globals(),
+    ) - forloop_overhead,
+)
+print(
+    "shm_bbb_array whole",
+    timeit(
+        "r, g, b = shm_bbb_array[order].T\n",
+        number=M,
+        globals=globals(),
+    ),
+)
 
 ###############################################################
 # Normal fff
@@ -117,6 +135,8 @@ for i in range(N):
 shm_fff_data = shm_fff.data
 shm_fff_struct = shm_fff.struct
 shm_fff_struct_size = shm_fff_struct.size
+shm_fff_array = shm_fff.as_array()
+shm_fff_cast = get_memory_view_cast(shm_fff._smh_name, "f", (N*3,))
 ###############################################################
 print(
     "builtin_tuple_normal",
@@ -139,3 +159,35 @@ print(
         globals=globals(),
     ) - forloop_overhead,
 )
+print(
+    "shm_fff_cast",
+    timeit(
+        "for i in order:\n"
+        " address = i*3\n"
+        " x = shm_fff_cast[address]\n"
+        " y = shm_fff_cast[address+1]\n"
+        " z = shm_fff_cast[address+2]\n",
+        number=M,
+        globals=globals(),
+    ) - forloop_overhead,
+)
+print(
+    "shm_fff_array",
+    timeit(
+        "for i in order:\n"
+        " normal = shm_fff_array[i]\n",
+        number=M,
+        globals=globals(),
+    ) - forloop_overhead,
+)
+print(
+    "shm_fff_array whole",
+    timeit(
+        "x, y, z = shm_fff_array[order].T\n",
+        number=M,
+        globals=globals(),
+    ),
+)
+
+# numpy views must be released before the shared memory is closed
+del shm_bbb_array, shm_fff_array